@@ -8,10 +8,11 @@
 #
 
 import asyncio
-import functools
 import inspect
 import logging
 import sys
+import traceback
+import types
 import weakref
 
 PY34 = sys.version_info >= (3, 4)
@@ -20,10 +21,19 @@ PY35 = sys.version_info >= (3, 5)
 logger = logging.getLogger(__name__)
 
 TMP_CONTEXT = []
-TRANSACTIONS = {}
+TRANSACTIONS = weakref.WeakKeyDictionary()
+PARENTS = weakref.WeakKeyDictionary()
 
 _nodefault = object()
 
+_current_task = asyncio.Task.current_task
+_get_event_loop = asyncio.get_event_loop
+
+if PY35:
+    # checked before falling back to inspect.isawaitable()
+    _awaitable_types = (asyncio.Future, types.CoroutineType,
+                        types.GeneratorType)
+
 __all__ = ('Transaction', 'get', 'begin', 'end', 'wait_all')
 
 try:
@@ -40,14 +50,24 @@ class Transaction:
     """A mechanism to store coroutines and consume them later.
     """
 
+    __slots__ = ('registry', 'coros', '_coros_set', 'loop', '_task_id',
+                 '_index', '_task_ref', 'open', 'ending', 'ending_fut',
+                 'parent', 'children', 'task_ending_fut', '_caller_info',
+                 '__weakref__')
+
     def __init__(self, trans_id, *, loop=None, registry=None, parent=None):
         self.registry = registry or TRANSACTIONS
         self.coros = []
-        self.loop = loop or asyncio.get_event_loop()
-        self.id = trans_id
+        self._coros_set = set()
+        self.loop = loop or _get_event_loop()
+        if trans_id is None:
+            self._task_id = self._index = None
+        else:
+            self._task_id, self._index = trans_id
+        self._task_ref = None
         self.open = True
         self.ending = False
-        self.ending_fut = self.loop.create_future()
+        self.ending_fut = None
         self.parent = parent
         self.children = []
         self.task_ending_fut = self.loop.create_future()
@@ -55,7 +75,7 @@ class Transaction:
 
     @asyncio.coroutine
     def __aenter__(self):
-        if self.id is None:
+        if self._task_id is None:
             task = self._get_current_task(self.loop)
             if task:
                 self._set_transaction_id(task, self, self.registry)
@@ -81,32 +101,41 @@ class Transaction:
         TMP_CONTEXT.pop()
         return False
 
+    @property
+    def id(self):
+        """The id of the owner task and the position of this transaction
+        among the ones it has begun, or ``None``.
+        """
+        if self._task_id is not None:
+            return (self._task_id, self._index)
+
     def __repr__(self):
         return '<%s id: %s number of items: %d state: %s>' % \
             (self.__class__.__name__, self.id, len(self.coros),
              'open' if self.open else 'closed')
 
     def _add_finalization_cb(self, task):
-        task.add_done_callback(functools.partial(self._owner_task_finalization_cb,
-                                                 weakref.ref(self)))
+        task.add_done_callback(self._owner_task_finalization_cb)
+
+    def _remove_finalization_cb(self):
+        task = self._task_ref() if self._task_ref is not None else None
+        if task is not None:
+            # don't let a task that outlives this transaction keep it alive
+            task.remove_done_callback(self._owner_task_finalization_cb)
 
     @staticmethod
     def _get_current_task(loop=None):
-        return asyncio.Task.current_task(loop=loop)
+        return _current_task(loop=loop)
 
-    @staticmethod
-    def _owner_task_finalization_cb(trans_ref, task):
+    def _owner_task_finalization_cb(self, task):
         """Warn about non-automatic one left open.
         """
-        trans = trans_ref()
+        self.task_ending_fut.set_result(None)
 
-        if trans:
-            trans.task_ending_fut.set_result(None)
-
-        if trans and trans.open and len(trans.coros) > 0:
+        if self.open and self.coros:
             msg = ("A transaction has not been closed: %r%s",
-                   trans, ", but it has a parent")
-            if trans.parent:
+                   self, ", but it has a parent")
+            if self.parent:
                 logger.warning(*msg)
             else:
                 logger.error(*msg)
@@ -116,41 +145,55 @@ class Transaction:
     def _set_transaction_id(task, transaction, registry=None):
         if task is None:
             raise TransactionError('No current task')
-        if transaction.id != None:
+        if transaction._task_id is not None:
             raise TransactionError('Transaction has an id already')
         registry = registry or TRANSACTIONS
-        task_id = id(task)
-        trans_list = registry.get(task_id)
-        if not trans_list:
-            registry[task_id] = trans_list = []
-        transaction.id = (task_id, len(trans_list))
+        trans_list = registry.setdefault(task, [])
+        transaction._task_id = id(task)
+        transaction._index = len(trans_list)
+        # the registry is keyed by the task, don't keep it alive
+        transaction._task_ref = weakref.ref(task)
         trans_list.append(transaction)
 
     def add(self, *coros, cback=None):
         """Add a coroutine or awaitable to the set managed by this
         transaction.
         """
-        if self.id is None and self not in TMP_CONTEXT:
+        if self._task_id is None and self not in TMP_CONTEXT:
             raise TransactionError('This transaction is not associated with any'
                                    ' task')
-        if self.ending or not open:
+        if self.ending or not self.open:
             raise ValueError("Cannot add coros to an ending or closed"
                              " transaction: %r" % self)
         out_coros = []
         for coro in coros:
-            if PY35:
-                assert inspect.isawaitable(coro)
-            if coro not in self.coros:
-                coro = asyncio.ensure_future(coro, loop=self.loop)
-                sub_trans = Transaction.begin(loop=self.loop, task=coro,
-                                              parent=self)
-                self.children.append(sub_trans)
+            assert not PY35 or (isinstance(coro, _awaitable_types) or
+                                inspect.isawaitable(coro))
+            if id(coro) not in self._coros_set:
+                if not isinstance(coro, asyncio.Future):
+                    if asyncio.iscoroutine(coro):
+                        coro = self.loop.create_task(coro)
+                    else:
+                        # other awaitables
+                        coro = ensure_future(coro, loop=self.loop)
+                # the sub-transaction is begun by get() only if needed;
+                # self holds the task, so a strong reference would keep
+                # the entry alive forever
+                PARENTS[coro] = weakref.ref(self)
                 if cback:
                     coro.add_done_callback(cback)
                 self.coros.append(coro)
+                self._coros_set.add(id(coro))
             out_coros.append(coro)
         return out_coros
 
+    def _begin_child(self, task, registry=None):
+        """Begin the sub-transaction of an added `task`."""
+        sub_trans = Transaction.begin(loop=self.loop, registry=registry,
+                                      task=task, parent=self)
+        self.children.append(sub_trans)
+        return sub_trans
+
     @classmethod
     def begin(cls, loop=None, *, registry=None, task=None, parent=None):
         """Begin a new transaction"""
@@ -158,8 +201,9 @@ class Transaction:
         trans = cls(None, loop=loop, registry=registry, parent=parent)
 
         if __debug__:
-            import inspect
-            trans._caller_info = inspect.stack()[1:5]
+            # no frames here, they would keep the task alive
+            trans._caller_info = traceback.extract_stack(sys._getframe(1),
+                                                         limit=4)
 
         task = task or cls._get_current_task(trans.loop)
         if task:
@@ -177,16 +221,16 @@ class Transaction:
         exceptions.
         """
         if not self.ending:
+            if self.ending_fut is None:
+                self.ending_fut = self.loop.create_future()
             if self.parent is not None:
                 yield from self.task_ending_fut
 
             self.ending = True
 
-            yield from asyncio.gather(*(c.end() for c in self.children),
-                                      loop=self.loop)
             try:
                 # reraise possible exceptions
-                if len(self.coros):
+                if self.coros:
                     result = yield from self.wait()
                 else:
                     result = None
@@ -196,15 +240,26 @@ class Transaction:
             finally:
                 logger.debug('Ending transaction: %r', self)
                 self.open = False
+                # the coros have run, so all the sub-transactions that
+                # they needed have been begun
+                if self.children:
+                    yield from asyncio.gather(*(c.end() for c in self.children),
+                                              loop=self.loop)
                 self.remove(self)
+                self._remove_finalization_cb()
                 del self.registry
                 del self.coros
+                del self._coros_set
                 del self.loop
                 del self.parent
                 del self.children
         return self.ending_fut
 
     def gather(self, *coros):
+        """Add the coros to this transaction and return the future of
+        ``asyncio.gather()`` on them, whose result is always a list, even
+        with a single coro.
+        """
         return asyncio.gather(*self.add(*coros), loop=self.loop)
 
     @classmethod
@@ -214,34 +269,40 @@ class Transaction:
         the passed-in `default`.
         """
         if loop is None:
-            loop = asyncio.get_event_loop()
-        task = task or asyncio.Task.current_task(loop=loop)
+            loop = _get_event_loop()
+        task = task or _current_task(loop=loop)
         registry = registry or TRANSACTIONS
-        task_id = id(task)
-        trans_list = registry.get(task_id)
+        trans_list = registry.get(task) if task is not None else None
         if trans_list:
-            result = trans_list[-1]
+            return trans_list[-1]
+        parent_ref = PARENTS.get(task) if task is not None else None
+        parent = parent_ref() if parent_ref is not None else None
+        if parent is not None and parent.open:
+            result = parent._begin_child(task, registry)
         elif TMP_CONTEXT:
             result = TMP_CONTEXT[-1]
+        elif default is _nodefault:
+            raise TransactionError("There's no transaction"
+                                   " begun for task %s" % id(task))
         else:
-            if default is _nodefault:
-                raise TransactionError("There's no transaction"
-                                       " begun for task %s" % task_id)
-            else:
-                result = default
+            result = default
         return result
 
     @classmethod
     def remove(cls, trans):
         """Remove a transaction from its registry."""
-        if trans.id:
-            registry = trans.registry
-            trans_list = registry[trans.id[0]]
-            assert len(trans_list) > 0
-            top_trans = trans_list.pop()
-            assert trans is top_trans
-            if len(trans_list) == 0:
-                del registry[trans.id[0]]
+        if trans._task_ref is not None:
+            task = trans._task_ref()
+            if task is None:
+                # the task is gone and its entry with it
+                return
+            # usually there's just one transaction per task, so take
+            # the entry out and put it back only when there are others
+            trans_list = trans.registry.pop(task)
+            if len(trans_list) > 1 or trans_list[-1] is not trans:
+                trans.registry[task] = trans_list
+            assert trans_list[-1] is trans
+            trans_list.pop()
 
     @asyncio.coroutine
     def wait(self):
@@ -250,10 +311,24 @@ class Transaction:
         """
         if not self.open:
             raise TransactionError("This transaction is closed already")
-        if len(self.coros):
+        if self.coros:
             logger.debug('Waiting for this transaction coros to complete: %r', self)
-            result = asyncio.gather(*self.coros, loop=self.loop)
-            self.coros.clear()
+            pending, self.coros = self.coros, []
+            self._coros_set.clear()
+            try:
+                if len(pending) == 1:
+                    # no need to gather a single one, just keep the same
+                    # result
+                    result = [(yield from pending[0])]
+                else:
+                    result = yield from asyncio.gather(*pending,
+                                                       loop=self.loop)
+            finally:
+                # the done callbacks added before wait() have run by now,
+                # any sub-transaction they needed has been begun
+                for fut in pending:
+                    if fut.done():
+                        PARENTS.pop(fut, None)
         else:
             result = None
         return result
@@ -266,14 +341,11 @@ class Transaction:
         """
         # TODO: take loop into account
         registry = registry or TRANSACTIONS
-        loop = loop or asyncio.get_event_loop()
+        loop = loop or _get_event_loop()
 
         # collect pending transactions
-        coros = set()
-        for task_id, transactions in registry.items():
-            for trans in transactions:
-                if not trans.parent:
-                    coros.add(trans.end())
+        coros = [trans.end() for transactions in registry.values()
+                 for trans in transactions if not trans.parent]
         if coros:
             result = asyncio.wait(coros, loop=loop, timeout=timeout)
         else:
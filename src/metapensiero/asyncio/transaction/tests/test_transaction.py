@@ -6,6 +6,8 @@
 #
 
 import asyncio
+import gc
+import weakref
 
 import pytest
 
@@ -274,7 +276,7 @@ def test_transaction_and_future(event_loop):
     def sync():
         trans = transaction.get(None, loop=event_loop)
         assert trans is not None
-        fut = asyncio.Future(loop=event_loop)
+        fut = event_loop.create_future()
         # there's no way to have some control on the order callbacks are
         # called so i we want to have a callback covered by the transaction,
         # we must add it to the transaction _after_ the callback
@@ -309,3 +311,154 @@ def test_transaction_and_future(event_loop):
     yield from external_coro()
     assert master_trans is not None
     assert end == 'done!'
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_sub_transaction_begun_on_demand(event_loop):
+
+    @asyncio.coroutine
+    def quiet_coro():
+        return 'quiet'
+
+    @asyncio.coroutine
+    def asking_coro():
+        trans = transaction.get(None)
+        assert trans is not None
+        return 'asking'
+
+    @asyncio.coroutine
+    def external_coro():
+        trans = transaction.begin(loop=event_loop)
+        trans.add(quiet_coro())
+        r = yield from trans.wait()
+        assert r == ['quiet']
+        assert trans.children == []
+        trans.add(asking_coro())
+        r = yield from trans.wait()
+        assert r == ['asking']
+        assert len(trans.children) == 1
+        assert trans.children[0].parent is trans
+        yield from trans.end()
+
+    yield from external_coro()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_nested_transactions(event_loop):
+
+    @asyncio.coroutine
+    def external_coro():
+        outer = transaction.begin(loop=event_loop)
+        inner = transaction.begin(loop=event_loop)
+        assert transaction.get(loop=event_loop) is inner
+        if __debug__:
+            # removing out of order doesn't touch the registry
+            with pytest.raises(AssertionError):
+                transaction.Transaction.remove(outer)
+            assert transaction.get(loop=event_loop) is inner
+        yield from inner.end()
+        assert transaction.get(loop=event_loop) is outer
+        yield from outer.end()
+        assert transaction.get(None, loop=event_loop) is None
+
+    yield from external_coro()
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_transaction_gather(event_loop):
+
+    @asyncio.coroutine
+    def coro(value):
+        return value
+
+    @asyncio.coroutine
+    def external_coro():
+        t = transaction.begin(loop=event_loop)
+        r1 = yield from t.gather(coro(1))
+        r2 = yield from t.gather(coro(2), coro(3))
+        yield from t.end()
+        return r1, r2
+
+    r = yield from external_coro()
+    assert r == ([1], [2, 3])
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_transaction_and_future_callback_after_add(event_loop):
+
+    master_trans = None
+    found = None
+
+    def future_callback(future):
+        nonlocal found
+        # the callback is added after the future, but the transaction
+        # has to be found anyway
+        trans = transaction.get(None, loop=event_loop, task=future)
+        found = trans and trans.parent
+
+    @asyncio.coroutine
+    def external_coro():
+        nonlocal master_trans
+        trans = transaction.begin(loop=event_loop)
+        master_trans = trans
+        fut = event_loop.create_future()
+        trans.add(fut)
+        fut.add_done_callback(future_callback)
+        event_loop.call_soon(fut.set_result, 'done')
+        yield from trans.end()
+
+    yield from external_coro()
+    assert found is master_trans
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_registry_entry_collected_with_task(event_loop):
+
+    @asyncio.coroutine
+    def stashed_coro():
+        pass
+
+    @asyncio.coroutine
+    def forgetful_coro():
+        # the caller's frame references the task
+        task = asyncio.Task.current_task(loop=event_loop)
+        # never ended
+        trans = transaction.begin(loop=event_loop, task=task)
+        trans.add(stashed_coro())
+
+    entries = len(transaction.TRANSACTIONS)
+    parents = len(transaction.PARENTS)
+    tasks = [asyncio.ensure_future(forgetful_coro(), loop=event_loop)
+             for i in range(5)]
+    yield from asyncio.wait(tasks, loop=event_loop)
+    assert len(transaction.TRANSACTIONS) == entries + 5
+    task_refs = [weakref.ref(t) for t in tasks]
+    del tasks
+    gc.collect()
+    assert all(ref() is None for ref in task_refs)
+    assert len(transaction.TRANSACTIONS) == entries
+    assert len(transaction.PARENTS) == parents
+
+
+@pytest.mark.asyncio
+@asyncio.coroutine
+def test_ended_transactions_collected_while_task_runs(event_loop):
+
+    @asyncio.coroutine
+    def stashed_coro():
+        return object()
+
+    trans_refs = []
+    for i in range(10):
+        trans = transaction.begin(loop=event_loop)
+        trans.add(stashed_coro())
+        yield from trans.end()
+        trans_refs.append(weakref.ref(trans))
+    del trans
+    gc.collect()
+    assert all(ref() is None for ref in trans_refs)